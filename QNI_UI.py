@@ -210,6 +210,12 @@ class Ui_MainWindowQNI(object):
         self.progressBar.setObjectName("progressBar")
         self.verticalLayout_3.addWidget(self.progressBar)
         self.horizontalLayout_12.addLayout(self.verticalLayout_3)
+        self.labelPreview = QtWidgets.QLabel(self.centralwidget)
+        self.labelPreview.setMinimumSize(QtCore.QSize(300, 300))
+        self.labelPreview.setFrameShape(QtWidgets.QFrame.Shape.StyledPanel)
+        self.labelPreview.setAlignment(QtCore.Qt.AlignmentFlag.AlignCenter)
+        self.labelPreview.setObjectName("labelPreview")
+        self.horizontalLayout_12.addWidget(self.labelPreview)
         MainWindowQNI.setCentralWidget(self.centralwidget)
         self.statusbar = QtWidgets.QStatusBar(MainWindowQNI)
         self.statusbar.setObjectName("statusbar")
@@ -244,3 +250,4 @@ class Ui_MainWindowQNI(object):
         self.lineEditHeight.setText(_translate("MainWindowQNI", "800"))
         self.pushButtonStart.setText(_translate("MainWindowQNI", "Start"))
         self.pushButtonStop.setText(_translate("MainWindowQNI", "Stop"))
+        self.labelPreview.setText(_translate("MainWindowQNI", "Preview"))
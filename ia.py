@@ -0,0 +1,106 @@
+# ia stands for "image archives"
+import io
+import os
+import tarfile
+import time
+import zipfile
+from PIL import Image
+from iu import supported_extension, save_frames
+
+
+_ZIP_EXTENSIONS = [".zip"]
+# Tar extensions and the compression used when writing them.
+_TAR_EXTENSIONS = {".tar": "", ".tar.gz": "gz", ".tgz": "gz", ".tar.bz2": "bz2",
+                   ".tbz2": "bz2", ".tar.xz": "xz", ".txz": "xz"}
+
+
+def is_zip(path):
+    return any(path.lower().endswith(ext) for ext in _ZIP_EXTENSIONS)
+
+
+def tar_compression(path):
+    for ext, compression in _TAR_EXTENSIONS.items():
+        if path.lower().endswith(ext):
+            return compression
+    return None
+
+
+def is_tar(path):
+    return tar_compression(path) is not None
+
+
+def is_archive(path):
+    return is_zip(path) or is_tar(path)
+
+
+def archive_names(path):
+    if is_zip(path):
+        with zipfile.ZipFile(path) as archive:
+            return [info.filename for info in archive.infolist()
+                    if not info.is_dir() and supported_extension(info.filename)]
+
+    with tarfile.open(path, "r|*") as archive:
+        return [member.name for member in archive
+                if member.isfile() and supported_extension(member.name)]
+
+
+def member_output_name(name):
+    # Members keep their folders so same-named files stay apart, but absolute
+    # paths and ".." parts are dropped so nothing lands outside the output.
+    parts = [part for part in name.replace("\\", "/").split("/")
+             if part not in ("", ".", "..") and not part.endswith(":")]
+    return "/".join(parts)
+
+
+def archive_members(path):
+    # Yields (name, data) for every supported image in the archive without
+    # extracting anything to disk. Tar archives are read as a stream, so
+    # compressed tarballs are decompressed once, front to back.
+    if is_zip(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and supported_extension(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and supported_extension(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+
+def encode_image(image, name):
+    extension = os.path.splitext(name)[1].lower()
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[extension])
+    return buffer.getvalue()
+
+
+def encode_frames(frames, name, **params):
+    extension = os.path.splitext(name)[1].lower()
+    buffer = io.BytesIO()
+    save_frames(frames, buffer, Image.registered_extensions()[extension], **params)
+    return buffer.getvalue()
+
+
+class ArchiveWriter:
+    # Writes members sequentially. Zip members are stored, not deflated, since
+    # the encoded images are already compressed.
+    def __init__(self, path):
+        self.path = path
+        if is_zip(path):
+            self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(path, "w|" + tar_compression(path))
+
+    def write(self, name, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
@@ -0,0 +1,157 @@
+# idx stands for "index"
+import hashlib
+import os
+import sqlite3
+from iu import supported_extension, is_multi_frame, image_boundbox, frames_boundbox
+
+
+BOUNDS_INDEX_NAME = ".ni_bounds.sqlite"
+SYNC_INDEX_NAME = ".ni_sync.sqlite"
+# Bumped whenever image_boundbox starts returning different values, so bounds
+# stored by an older detector are not reused.
+BOUNDS_VERSION = 1
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def bounds_index_path(output_f):
+    folder = output_f if os.path.isdir(output_f) else os.path.dirname(output_f)
+    return os.path.join(folder, BOUNDS_INDEX_NAME)
+
+
+def sync_index_path(output_f):
+    return os.path.join(output_f, SYNC_INDEX_NAME)
+
+
+class BoundsIndex:
+    # Bounds only depend on the input pixels and the tolerance, so they are keyed
+    # on a digest of the input file and survive padding/size changes.
+    def __init__(self, path, commit_every=500):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        # Watch mode calls in from the observer thread, and parallel runs open
+        # one connection per worker process.
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != BOUNDS_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS bounds")
+            self.connection.execute(f"PRAGMA user_version = {BOUNDS_VERSION}")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS bounds (
+                digest TEXT NOT NULL,
+                tolerance INTEGER NOT NULL,
+                left INTEGER NOT NULL,
+                top INTEGER NOT NULL,
+                right INTEGER NOT NULL,
+                bottom INTEGER NOT NULL,
+                PRIMARY KEY (digest, tolerance))
+        """)
+
+    def get(self, digest, tolerance):
+        row = self.connection.execute(
+            "SELECT left, top, right, bottom FROM bounds WHERE digest = ? AND tolerance = ?",
+            (digest, tolerance)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, digest, tolerance, bounds):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO bounds VALUES (?, ?, ?, ?, ?, ?)",
+            (digest, tolerance, *bounds))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def indexed_bounds(image, key, tolerance, bounds_index, mark_collisions=False, show_grayscale=False):
+    # key is the digest of the encoded input file.
+    bounds = bounds_index.get(key, tolerance)
+    if bounds is None:
+        if is_multi_frame(image):
+            bounds = frames_boundbox(image, tolerance=tolerance)
+        else:
+            bounds = image_boundbox(image, tolerance=tolerance,
+                                    mark_collisions=mark_collisions, show_grayscale=show_grayscale)
+        bounds_index.put(key, tolerance, bounds)
+
+    return bounds
+
+
+class InputIndex:
+    # Remembers size and mtime of every input that was processed, and where its
+    # output went, so a sync run only touches new, modified or removed files.
+    def __init__(self, path, commit_every=500):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                output TEXT NOT NULL)
+        """)
+
+    def changes(self, input_f, force_replace=False):
+        # One query for the whole index and one stat per directory entry; only
+        # the returned files need decoding and writing. Unchanged inputs whose
+        # recorded output has gone missing cost one more stat and are returned
+        # too, so lost outputs get rebuilt. Paths are kept absolute.
+        input_f = os.path.abspath(input_f)
+        known = {path: ((size, mtime), output) for path, size, mtime, output in
+                 self.connection.execute("SELECT path, size, mtime, output FROM files")}
+        changed = []
+        seen = set()
+        with os.scandir(input_f) as entries:
+            for entry in entries:
+                if not entry.is_file() or not supported_extension(entry.name):
+                    continue
+                stat = entry.stat()
+                state = (stat.st_size, stat.st_mtime_ns)
+                seen.add(entry.path)
+                recorded, output = known.get(entry.path, (None, None))
+                if force_replace or recorded != state or not os.path.exists(output):
+                    changed.append((entry.path, *state))
+
+        removed = [path for path in known if path not in seen
+                   and os.path.dirname(path) == input_f]
+        return changed, removed
+
+    def output(self, path):
+        row = self.connection.execute(
+            "SELECT output FROM files WHERE path = ?", (path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, path, size, mtime, output):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, size, mtime, output))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def remove(self, path):
+        self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -1,9 +1,13 @@
 #!/usr/bin/python3
 # ipw stands for "image processing worker"
 from PyQt6.QtCore import (QObject, pyqtSignal, pyqtSlot, QTimer)
-from iu import (scale_to_fit)
+from iu import (scale_to_fit, image_boundbox, load_proxy, is_multi_frame,
+                frame_info, scale_frames_to_fit, save_frames, estimate_cost)
 from enum import Enum
+from ia import (is_archive, is_zip, archive_names, archive_members, member_output_name)
+from pr import ProgressReport
 from PIL import Image
+import io
 import os
 
 
@@ -17,6 +21,7 @@ class ImageProcessingWorker(QObject):
     result_image = pyqtSignal(str, Image.Image, float)
     finished = pyqtSignal(float)
     error = pyqtSignal(str)
+    status = pyqtSignal(str)
 
     def __init__(self, input, output, mode=Mode.FILE, padding=50, tolerance=5,
                  image_size=(800, 800), output_extension="*.jpg", force_replace=False,  mark_collisions=False,
@@ -37,8 +42,14 @@ class ImageProcessingWorker(QObject):
         self.input_folder = ""
         self.output_extension = output_extension
 
+        # Archive members are streamed one per tick, so file_list stays empty
+        # and nothing is read from the archive until start().
+        self.members = None
+
         print("Original input: ", self.input)
-        if self.mode == Mode.FILE:
+        if is_archive(self.input) and os.path.isfile(self.input):
+            self.input_folder = os.path.split(self.input)[0]
+        elif self.mode == Mode.FILE:
             self.input_folder = os.path.split(self.input)[0]
             self.file_list = [os.path.split(self.input)[1]]
             print(self.input_folder, self.file_list[0])
@@ -53,6 +64,20 @@ class ImageProcessingWorker(QObject):
         self._stop = False
         self.index = 0
         self.current_file_index = 0
+        self.costs = {}
+        if is_archive(self.input) and os.path.isfile(self.input):
+            self.members = archive_members(self.input)
+            # Same as ni.py: only a zip's central directory gives a count for
+            # free, tarballs would have to be decompressed twice.
+            self.report = ProgressReport(
+                total_count=len(archive_names(self.input)) if is_zip(self.input) else 0)
+        else:
+            # Header-only pixel counts weight the progress and put the largest
+            # images first.
+            self.costs = {filename: estimate_cost(os.path.join(self.input_folder, filename))
+                          for filename in self.file_list}
+            self.file_list.sort(key=lambda filename: self.costs[filename], reverse=True)
+            self.report = ProgressReport(sum(self.costs.values()), len(self.file_list))
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.run)
         self.timer.start(500)
@@ -69,30 +94,118 @@ class ImageProcessingWorker(QObject):
             self.finished.emit(100)
             return
 
-        if self.index >= len(self.file_list):
+        if self.members is None and self.index >= len(self.file_list):
             self.timer.stop()
             self.index = 0
             self._stop = True
             self.finished.emit(100)
             return
 
-        if os.path.exists(os.path.join(self.output, self.file_list[self.index])) and not self.force_replace:
-            completion = (self.index/len(self.file_list)*100)
+        data = None
+        if self.members is not None:
+            try:
+                name, data = next(self.members)
+            except StopIteration:
+                self.members = None
+                self.timer.stop()
+                self.index = 0
+                self._stop = True
+                self.finished.emit(100)
+                return
+            filename = member_output_name(name)
+            cost = estimate_cost(name, data)
+        else:
+            filename = self.file_list[self.index]
+            cost = self.costs[filename]
+
+        if os.path.exists(os.path.join(self.output, filename)) and not self.force_replace:
+            self.report.skip(cost)
+            completion = self.report.completion()
             self.result_image.emit(os.path.join(
-                self.output, self.file_list[self.index]), Image.open(os.path.join(self.output, self.file_list[self.index])), completion)
+                self.output, filename), Image.open(os.path.join(self.output, filename)), completion)
             self.index += 1
             return
 
-        img = Image.open(os.path.join(str(self.input_folder),
-                         str(self.file_list[self.index])))
+        if data is not None:
+            img = Image.open(io.BytesIO(data))
+            img.filename = name
+        else:
+            img = Image.open(os.path.join(str(self.input_folder),
+                             str(filename)))
 
-        img = scale_to_fit(img,  padding=self.padding, tolerance=self.tolerance,
-                           image_size=self.image_size, mark_collisions=self.mark_collisions,
-                           show_grayscale=self.show_grayscale, show_color=self.show_color,
-                           write_log=self.write_log)
-        img.save(os.path.join(self.output, self.file_list[self.index]))
+        output = os.path.join(self.output, filename)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        if is_multi_frame(img):
+            frames = scale_frames_to_fit(img, padding=self.padding, tolerance=self.tolerance,
+                                         image_size=self.image_size, write_log=self.write_log)
+            img = save_frames(frames, output,
+                              Image.registered_extensions()[os.path.splitext(filename)[1].lower()],
+                              **frame_info(img))
+        else:
+            img = scale_to_fit(img,  padding=self.padding, tolerance=self.tolerance,
+                               image_size=self.image_size, mark_collisions=self.mark_collisions,
+                               show_grayscale=self.show_grayscale, show_color=self.show_color,
+                               write_log=self.write_log)
+            img.save(output)
 
-        completion = (self.index/len(self.file_list)*100)
+        self.report.advance(cost)
+        completion = self.report.completion()
         self.result_image.emit(os.path.join(
-            self.output, self.file_list[self.index]), img, completion)
+            self.output, filename), img, completion)
+        self.status.emit(f'{filename} | {self.report}')
         self.index += 1
+
+
+class PreviewWorker(QObject):
+    result_image = pyqtSignal(int, Image.Image)
+    error = pyqtSignal(int, str)
+
+    def __init__(self, proxy_size=512, preview_size=300, cache_size=8):
+        super().__init__()
+        self.proxy_size = proxy_size
+        self.preview_size = preview_size
+        self.cache_size = cache_size
+        # Generation of the most recent request, written by the GUI thread.
+        # Anything older is stale and gets dropped before doing work.
+        self.latest = 0
+        self.proxies = {}
+        self.bounds = {}
+
+    def proxy(self, input_f):
+        if input_f not in self.proxies:
+            if len(self.proxies) >= self.cache_size:
+                oldest = next(iter(self.proxies))
+                self.proxies.pop(oldest).close()
+                self.bounds = {key: value for key, value in self.bounds.items()
+                               if key[0] != oldest}
+            self.proxies[input_f] = load_proxy(input_f, self.proxy_size)
+        return self.proxies[input_f]
+
+    @pyqtSlot(int, str, int, int, object)
+    def render(self, generation, input_f, padding, tolerance, image_size):
+        if generation != self.latest:
+            return
+
+        try:
+            proxy = self.proxy(input_f)
+            if generation != self.latest:
+                return
+
+            # Bounds only depend on the pixels and tolerance, so padding and
+            # size changes only pay for the crop and resize.
+            if (input_f, tolerance) not in self.bounds:
+                self.bounds[(input_f, tolerance)] = image_boundbox(
+                    proxy, tolerance=tolerance)
+            if generation != self.latest:
+                return
+
+            scale = min(1, self.preview_size / max(image_size))
+            preview = scale_to_fit(proxy, padding=int(padding * scale), tolerance=tolerance,
+                                   image_size=(max(1, int(image_size[0] * scale)),
+                                               max(1, int(image_size[1] * scale))),
+                                   bounds=self.bounds[(input_f, tolerance)])
+        except Exception as err:
+            self.error.emit(generation, str(err))
+            return
+
+        self.result_image.emit(generation, preview)
@@ -1,7 +1,12 @@
 # iu stands for "image utils"
+import io
+import itertools
 import logging
+import math
 import os
-from PIL import ImageOps, Image
+import time
+import numpy as np
+from PIL import ImageOps, Image, ImageSequence, TiffImagePlugin
 
 
 _SUPPORTED_FORMATS = [".jpg", ".jpeg", ".bmp", ".dds", ".exif", ".gif",  ".jps", ".jp2",
@@ -15,63 +20,243 @@ def supported_extension(input):
     return False
 
 
-def image_boundbox(img, tolerance=5, mark_collisions=False, show_grayscale=False):
-    width = img.width
-    height = img.height
-
+def _mask_bbox(img, tolerance=5):
     img_grayscale = ImageOps.grayscale(img)
-    tolerance_range = list(range(255-tolerance+1, 256))
-
-    # find left bound
-    left = 0
-    for y in range(height):
-        for x in range(width):
-            if img_grayscale.getpixel((x, y)) not in tolerance_range:
-                if mark_collisions:
-                    img_grayscale.putpixel((x, y), (0))
-                if (x > left and left == 0) or (x < left and left != 0):
-                    left = x
-                break
-
-    right = width
-    for y in range(height):
-        for x in reversed(range(left, width)):
-            if img_grayscale.getpixel((x, y)) not in tolerance_range:
-                if mark_collisions:
-                    img_grayscale.putpixel((x, y), (0))
-                if x < right and right == width or x > right and right != width:
-                    right = x
-                break
-
-    top = 0
-    for x in range(left, right):
-        for y in range(height):
-            if img_grayscale.getpixel((x, y)) not in tolerance_range:
-                if mark_collisions:
-                    img_grayscale.putpixel((x, y), (0))
-                if y > top and top == 0 or y < top and top != 0:
-                    top = y
-                break
-
-    bottom = height
-    for x in range(left, right):
-        for y in reversed(range(top, height)):
-            if img_grayscale.getpixel((x, y)) not in tolerance_range:
-                if mark_collisions:
-                    img_grayscale.putpixel((x, y), (0))
-                if y < bottom and bottom == height or y > bottom and bottom != height:
-                    bottom = y
-                break
+    mask = img_grayscale.point(lambda v: 255 if v <= 255 - tolerance else 0)
+    bbox = mask.getbbox()
+    img_grayscale.close()
+    mask.close()
+    return bbox
+
+
+def _show_grayscale(img, tolerance=5, mark_collisions=False):
+    plane = np.array(ImageOps.grayscale(img))
+    if mark_collisions:
+        # Mark the first and last object pixel of every row and column.
+        mask = plane <= 255 - tolerance
+        height, width = mask.shape
+        ys = np.flatnonzero(mask.any(axis=1))
+        plane[ys, mask[ys].argmax(axis=1)] = 0
+        plane[ys, width - 1 - mask[ys, ::-1].argmax(axis=1)] = 0
+        xs = np.flatnonzero(mask.any(axis=0))
+        plane[mask[:, xs].argmax(axis=0), xs] = 0
+        plane[height - 1 - mask[::-1, xs].argmax(axis=0), xs] = 0
+    Image.fromarray(plane).show()
+
 
+def image_boundbox(img, tolerance=5, mark_collisions=False, show_grayscale=False):
+    # Bounds of every pixel darker than the tolerance allows, with right and
+    # bottom as the index of the last object column/row. The threshold and the
+    # scan both run inside PIL.
     if show_grayscale:
-        img_grayscale.show()
+        _show_grayscale(img, tolerance, mark_collisions)
+
+    bbox = _mask_bbox(img, tolerance)
+    if bbox is None:
+        return (0, 0, img.width, img.height)
+
+    left, top, right, bottom = bbox
+    return (left, top, right - 1, bottom - 1)
+
+
+def frames_boundbox(img, tolerance=5):
+    # Union of the bounds of every frame, so all frames are cropped alike and
+    # stay aligned. Frames are decoded and reduced one at a time.
+    union = None
+    for frame in ImageSequence.Iterator(img):
+        bbox = _mask_bbox(frame, tolerance)
+        if bbox is None:
+            continue
+        if union is None:
+            union = bbox
+        else:
+            union = (min(union[0], bbox[0]), min(union[1], bbox[1]),
+                     max(union[2], bbox[2]), max(union[3], bbox[3]))
+    img.seek(0)
+
+    if union is None:
+        return (0, 0, img.width, img.height)
+
+    left, top, right, bottom = union
+    return (left, top, right - 1, bottom - 1)
+
+
+def _stacked_boundbox(group, tolerance=5):
+    # One (batch, height, width) grayscale array per group of same-size images;
+    # all bounds come out of a single reduction over it, with the threshold of
+    # _mask_bbox.
+    planes = np.stack([np.asarray(ImageOps.grayscale(img)) for img in group])
+    _, height, width = planes.shape
+    mask = planes <= 255 - tolerance
+    columns = mask.any(axis=1)
+    rows = mask.any(axis=2)
+    found = columns.any(axis=1)
+    left = columns.argmax(axis=1)
+    right = width - 1 - columns[:, ::-1].argmax(axis=1)
+    top = rows.argmax(axis=1)
+    bottom = height - 1 - rows[:, ::-1].argmax(axis=1)
+
+    for i, img in enumerate(group):
+        if found[i]:
+            yield img, (int(left[i]), int(top[i]), int(right[i]), int(bottom[i]))
+        else:
+            yield img, (0, 0, width, height)
+
+
+def batch_boundbox(images, tolerance=5, batch_size=32):
+    # Yields (image, bounds) pairs as soon as a batch is reduced. The threshold
+    # and the inclusive right/bottom are image_boundbox's, so the bounds are
+    # identical to it, including (0, 0, width, height) for blank images. Images are grouped by size; at most
+    # batch_size images are held at once, so when many sizes are mixed the
+    # largest group is flushed early. Output order follows the batches, not
+    # the input.
+    groups = {}
+    held = 0
+    for img in images:
+        groups.setdefault(img.size, []).append(img)
+        held += 1
+        if held >= batch_size:
+            size = max(groups, key=lambda key: len(groups[key]))
+            group = groups.pop(size)
+            held -= len(group)
+            yield from _stacked_boundbox(group, tolerance)
+
+    for group in groups.values():
+        yield from _stacked_boundbox(group, tolerance)
+
+
+def is_multi_frame(img):
+    return getattr(img, "n_frames", 1) > 1
+
+
+def has_transparency(img):
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
 
-    img_grayscale.close()
 
-    return (left, top, right, bottom)
+def frame_info(img):
+    # Save parameters for a multi-frame output: duration and disposal per frame,
+    # since frames rarely share one timing, plus the loop count.
+    durations = []
+    disposals = []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(frame.info.get("duration", 0))
+        disposals.append(getattr(frame, "disposal_method", frame.info.get("disposal", 0)))
+    img.seek(0)
 
+    info = {"duration": durations, "disposal": disposals}
+    if "loop" in img.info:
+        info["loop"] = img.info["loop"]
+    return info
 
-def scale_to_fit(img, padding=50, tolerance=5, image_size=(800, 800), mark_collisions=False, show_grayscale=False, show_color=False, write_log=False):
+
+def estimate_cost(input_f, data=None):
+    # Pixel count from the header only; nothing is decoded.
+    try:
+        with Image.open(io.BytesIO(data) if data is not None else input_f) as img:
+            return img.width * img.height * getattr(img, "n_frames", 1)
+    except (OSError, ValueError):
+        return 0
+
+
+# Rough seconds per megapixel of the work analyze_image skips, measured on
+# JPEGs: decoding scales with the input, resizing with the cropped object and
+# encoding (and upscaling) with the output.
+DECODE_SECONDS_PER_MP = 0.006
+RESIZE_SECONDS_PER_MP = 0.015
+ENCODE_SECONDS_PER_MP = 0.01
+
+
+def analyze_image(input_f, data=None, padding=50, tolerance=5, image_size=(800, 800), reduce=4):
+    # Bounds and scale factor without resizing or encoding. Single-frame images
+    # are decoded at 1/reduce of their size where the decoder can (JPEG), else
+    # decoded and reduced, as a grayscale plane since that is all detection
+    # needs. Only image_boundbox is timed and extrapolated by pixel count;
+    # decoding and the skipped stages are estimated per megapixel.
+    img = Image.open(io.BytesIO(data) if data is not None else input_f)
+    width, height = img.size
+    frames = getattr(img, "n_frames", 1)
+
+    if frames > 1:
+        # Frames are decoded one by one inside frames_boundbox, so its time
+        # covers decoding as well.
+        started = time.monotonic()
+        left, top, right, bottom = frames_boundbox(img, tolerance=tolerance)
+        elapsed = time.monotonic() - started
+        empty = right >= width
+        touches_edge = not empty and (left <= 0 or top <= 0 or right >= width - 1 or bottom >= height - 1)
+        ratio = 1
+        decode_seconds = 0
+    else:
+        img.draft("RGB", (max(1, width // reduce), max(1, height // reduce)))
+        plane = ImageOps.grayscale(img)
+        if plane.width >= width and reduce > 1:
+            plane = plane.reduce(reduce)
+        fx, fy = width / plane.width, height / plane.height
+
+        started = time.monotonic()
+        left, top, right, bottom = image_boundbox(plane, tolerance=tolerance)
+        elapsed = time.monotonic() - started
+        # Edge contact is decided before mapping back, where the last reduced
+        # column still is the last column. Right/bottom map to the last full
+        # size pixel they cover.
+        empty = right >= plane.width
+        touches_edge = not empty and (left <= 0 or top <= 0 or right >= plane.width - 1
+                                      or bottom >= plane.height - 1)
+        if not empty:
+            left, top, right, bottom = (int(left * fx), int(top * fy),
+                                        min(width - 1, math.ceil((right + 1) * fx) - 1),
+                                        min(height - 1, math.ceil((bottom + 1) * fy) - 1))
+        else:
+            left, top, right, bottom = (0, 0, width, height)
+        ratio = (width * height) / (plane.width * plane.height)
+        decode_seconds = width * height / 1e6 * DECODE_SECONDS_PER_MP
+        plane.close()
+    img.close()
+
+    target_width, target_height = image_size
+    padded_width, padded_height = (
+        target_width - (2*padding), target_height - (2*padding))
+    object_width, object_height = right - left, bottom - top
+    # Same choice of axis as scale_to_fit.
+    if object_width > object_height:
+        scale = padded_width / object_width
+    else:
+        scale = padded_height / max(1, object_height)
+
+    return {
+        "file": input_f,
+        "width": width,
+        "height": height,
+        "frames": frames,
+        "left": left,
+        "top": top,
+        "right": right,
+        "bottom": bottom,
+        "object_width": object_width,
+        "object_height": object_height,
+        "scale": round(scale, 4),
+        "upscaled": scale > 1,
+        "empty": empty,
+        "touches_edge": touches_edge,
+        "cost": width * height * frames,
+        "estimated_detect_seconds": round(elapsed * ratio, 4),
+        "estimated_seconds": round(elapsed * ratio + decode_seconds + frames * (
+            object_width * object_height / 1e6 * RESIZE_SECONDS_PER_MP
+            + target_width * target_height / 1e6 * ENCODE_SECONDS_PER_MP), 4),
+    }
+
+
+def load_proxy(input_f, max_size=512):
+    img = Image.open(input_f)
+    # Let the decoder skip work (JPEG DCT scaling) before the real downscale.
+    img.draft("RGB", (max_size, max_size))
+    proxy = img.convert("RGB")
+    img.close()
+    proxy.thumbnail((max_size, max_size))
+    return proxy
+
+
+def scale_to_fit(img, padding=50, tolerance=5, image_size=(800, 800), mark_collisions=False, show_grayscale=False, show_color=False, write_log=False, bounds=None, background=(255, 255, 255)):
     if write_log:
         logging.info('Image: %s ------------------',
                      os.path.basename(img.filename))
@@ -80,9 +265,11 @@ def scale_to_fit(img, padding=50, tolerance=5, image_size=(800, 800), mark_colli
     # Padded width/height of resulting image.
     padded_width, padded_height = (
         target_width - (2*padding), target_height - (2*padding))
-    # Get rect area of object inside image.
-    left, top, right, bottom = image_boundbox(
-        img, tolerance=tolerance, mark_collisions=mark_collisions, show_grayscale=show_grayscale)
+    # Get rect area of object inside image, unless the caller already knows it.
+    if bounds is None:
+        bounds = image_boundbox(
+            img, tolerance=tolerance, mark_collisions=mark_collisions, show_grayscale=show_grayscale)
+    left, top, right, bottom = bounds
     # Crop image to contain only the object
     actual_object = img.crop((left, top, right, bottom))
     # Object width/height
@@ -116,11 +303,50 @@ def scale_to_fit(img, padding=50, tolerance=5, image_size=(800, 800), mark_colli
         logging.info('----------------------------\n')
 
     actual_object = actual_object.resize((new_size_x, new_size_y))
+    # A 4-tuple background gives an RGBA canvas, so transparency survives.
     result = Image.new(
-        "RGB", (target_width, target_height), (255, 255, 255))
+        "RGBA" if len(background) == 4 else "RGB", (target_width, target_height), background)
     result.paste(actual_object, (int((target_width/2) -
                  (new_size_x / 2)), int((target_height/2) - (new_size_y/2))))
     if show_color:
         result.show()
 
     return result
+
+
+def scale_frames_to_fit(img, padding=50, tolerance=5, image_size=(800, 800), write_log=False, bounds=None):
+    if bounds is None:
+        bounds = frames_boundbox(img, tolerance=tolerance)
+    # Transparent animations are kept transparent instead of flattened on white.
+    transparent = has_transparency(img)
+    for frame in ImageSequence.Iterator(img):
+        if transparent:
+            converted = frame.convert("RGBA")
+            converted.filename = img.filename
+            frame = converted
+        yield scale_to_fit(frame, padding=padding, tolerance=tolerance, image_size=image_size,
+                           write_log=write_log, bounds=bounds,
+                           background=(255, 255, 255, 0) if transparent else (255, 255, 255))
+
+
+def save_frames(frames, fp, format, **params):
+    # frames is consumed lazily. TIFF pages are appended one by one; formats with
+    # save_all pull append_images from the iterator (APNG excepted). Anything
+    # else keeps the first frame only.
+    first = next(frames)
+    if format == "TIFF":
+        with TiffImagePlugin.AppendingTiffWriter(fp, True) as tf:
+            for frame in itertools.chain([first], frames):
+                frame.save(tf, format="TIFF")
+                tf.newFrame()
+    elif format == "PNG":
+        # The APNG encoder walks append_images once for the modes before
+        # writing, which would drain an iterator; it needs the frames in memory.
+        first.save(fp, format=format, save_all=True,
+                   append_images=list(frames), **params)
+    elif format in Image.SAVE_ALL:
+        first.save(fp, format=format, save_all=True,
+                   append_images=frames, **params)
+    else:
+        first.save(fp, format=format)
+    return first
@@ -0,0 +1,68 @@
+# nf stands for "normalize file"
+import io
+import os
+from PIL import Image
+from iu import (scale_to_fit, supported_extension, is_multi_frame, frame_info, scale_frames_to_fit,
+                save_frames)
+from ia import encode_image, encode_frames
+
+
+def open_image(input_f, data=None):
+    # Archive members arrive as bytes; files are read once so the same bytes can
+    # feed both the bounds index key and the decoder.
+    if data is None:
+        with open(input_f, "rb") as f:
+            data = f.read()
+    image = Image.open(io.BytesIO(data))
+    image.filename = input_f
+    return image, data
+
+
+def output_path(input_f, output_f):
+    return os.path.join(output_f, os.path.basename(input_f))
+
+
+def output_file(output_f, name):
+    if supported_extension(output_f):
+        return output_f
+    # Archive members keep their folders, so those are created on demand.
+    output = os.path.join(output_f, name)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    return output
+
+
+def normalize_image(image, input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log, bounds=None, output_archive=None, name=None):
+    # name is the output path relative to output_f; archive members pass their
+    # member path, everything else is written under its file name.
+    if name is None:
+        name = os.path.basename(input_f)
+
+    if is_multi_frame(image):
+        process_frames(image, input_f, output_f, padding, tolerance,
+                       image_size, write_log, bounds, output_archive, name)
+        return
+
+    image = scale_to_fit(image,  padding=padding, tolerance=tolerance, image_size=image_size,
+                         mark_collisions=mark_collisions, show_grayscale=show_grayscale, show_color=show_color, write_log=write_log,
+                         bounds=bounds)
+    if output_archive is not None:
+        output_archive.write(name, encode_image(image, name))
+    else:
+        image.save(output_file(output_f, name))
+    image.close()
+
+
+def process_frames(image, input_f, output_f, padding, tolerance, image_size, write_log, bounds=None, output_archive=None, name=None):
+    # Multi-page TIFFs and animated GIFs share one union bounding box and are
+    # streamed frame by frame into the encoder.
+    frames = scale_frames_to_fit(image, padding=padding, tolerance=tolerance, image_size=image_size,
+                                 write_log=write_log, bounds=bounds)
+    if name is None:
+        name = os.path.basename(input_f)
+    if output_archive is not None:
+        output_archive.write(name, encode_frames(frames, name, **frame_info(image)))
+    else:
+        output = output_file(output_f, name)
+        save_frames(frames, output, Image.registered_extensions()[os.path.splitext(output)[1].lower()],
+                    **frame_info(image))
+    image.close()
@@ -4,15 +4,23 @@
 import getopt
 import sys
 import os
+import csv
+import json
 import logging
-from iu import scale_to_fit, supported_extension
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from iu import supported_extension, batch_boundbox, is_multi_frame, estimate_cost, analyze_image
+from idx import BoundsIndex, InputIndex, bounds_index_path, sync_index_path, digest, indexed_bounds
+from ia import is_archive, is_zip, archive_names, archive_members, member_output_name, ArchiveWriter
+from nf import open_image, output_path, normalize_image
+from pr import ProgressReport
+from pp import run_pipeline, utilization_report
 from PIL import Image
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 
 class EventHandler(FileSystemEventHandler):
-    def __init__(self, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log):
+    def __init__(self, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log, bounds_index=None, sync_index=None, prune=False):
         self.output_f = output_f
         self.padding = padding
         self.tolerance = tolerance
@@ -21,10 +29,19 @@ class EventHandler(FileSystemEventHandler):
         self.show_grayscale = show_grayscale
         self.show_color = show_color
         self.write_log = write_log
+        self.bounds_index = bounds_index
+        self.sync_index = sync_index
+        self.prune = prune
 
     def process_event(self, event):
+        if self.sync_index is not None:
+            stat = os.stat(event.src_path)
         process_image(event.src_path, self.output_f, self.padding, self.tolerance, self.image_size,
-                      self.mark_collisions, self.show_grayscale, self.show_color, self.write_log)
+                      self.mark_collisions, self.show_grayscale, self.show_color, self.write_log,
+                      self.bounds_index)
+        if self.sync_index is not None:
+            sync_output(self.sync_index, event.src_path, self.output_f, stat.st_size, stat.st_mtime_ns)
+            self.sync_index.commit()
 
     def on_closed(self, event):
         self.process_event(event)
@@ -33,7 +50,9 @@ class EventHandler(FileSystemEventHandler):
         pass  # self.process_event(event)
 
     def on_deleted(self, event):
-        pass
+        if self.sync_index is not None and self.prune:
+            prune_output(self.sync_index, os.path.abspath(event.src_path))
+            self.sync_index.commit()
 
     def on_modified(self, event):
         pass
@@ -55,8 +74,10 @@ def usage():
                                 Eg: -s "800 800"
             -i, --input         Input file location. If file location is file it will use single image mode.
                                 If input file location is a folder, all files in the folder will be processed.
+                                If it is a zip/tar archive, its images are read without extracting them.
             -o, --output        Can be directory where the image will be stored with the same name.
                                 Or it can be a folder where all images will be store at.
+                                If it is a zip/tar archive path, results are written into a new archive.
             -t, --tolerance     Used to control how much tolerance in color values the algorithm will have.
                                 The bigger the tolerance the less pixels will pass the algorithm's test.
             -p, --padding       How much wite space witll the result image have around the object.
@@ -70,20 +91,237 @@ def usage():
             -h, --help          Shows this manual.
             -w, --watch         Run script as a watcher that notices file changes in input directory and
                                 outputs the result in the output directory.
+            -b, --bounds-index  Keep detected bounding boxes in an index inside the output folder, keyed by
+                                input file hash and tolerance. Re-runs with a different padding or size
+                                skip detection for images already in the index.
+            --index-only        Only detect bounding boxes and store them in the index. Nothing is resized
+                                or written. Implies -b.
+            -j, --jobs          Number of worker processes for folder input. Images are scheduled by
+                                estimated cost, largest first. Archive output always uses one process.
+            --sync              Keep an index of input size/mtime in the output folder and only process new or
+                                modified images, or images whose output has gone missing. With -w the backlog
+                                is reconciled before watching starts.
+            --prune             With --sync, delete outputs whose input image is gone.
+            --pipeline          Run decode, bbox/resize and encode as separate process stages that hand
+                                pixels over through shared memory. Takes the worker count of each stage,
+                                Eg: --pipeline "1 3 1". Prints how busy each stage was at the end. Only for
+                                folder input and output; works with -b, -l, -r and --sync but not with -j,
+                                --batch, -m, -g or -c. Images too large for the shared memory budget, and
+                                multi-frame images, are processed whole in a decode worker.
+            --analyze           Dry run. Only detect bounding boxes, on images decoded at reduced size, and
+                                write a per-file report of bounds, scale factor, edge contact, blank images,
+                                estimated detection time and estimated total time (detection plus a
+                                per-megapixel figure for decode, resize and encode) to the given .csv or
+                                .json file. Blank images are not counted as touching an edge.
+                                Nothing is resized or written.
+                                Eg: --analyze report.csv
+            --batch             Detect bounding boxes for this many same-size images at once. Bounds and crops
+                                are the same as without it. Used for folder input with a single process and
+                                without -g or -m; with -b the index supplies the bounds instead.
     """)
 
     print(output_string)
 
 
-def process_image(input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log):
-    image = Image.open(input_f)
-    image = scale_to_fit(image,  padding=padding, tolerance=tolerance, image_size=image_size,
-                         mark_collisions=mark_collisions, show_grayscale=show_grayscale, show_color=show_color, write_log=write_log)
-    image.save(output_f if supported_extension(output_f)
-               else os.path.join(output_f, os.path.basename(input_f)))
+def index_image(input_f, tolerance, bounds_index, data=None):
+    image, data = open_image(input_f, data)
+    indexed_bounds(image, digest(data), tolerance, bounds_index)
     image.close()
 
 
+def process_image(input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log, bounds_index=None, data=None, output_archive=None, name=None):
+    bounds = None
+    if bounds_index is None and data is None:
+        image = Image.open(input_f)
+    else:
+        image, data = open_image(input_f, data)
+        if bounds_index is not None:
+            bounds = indexed_bounds(image, digest(data), tolerance, bounds_index,
+                                    mark_collisions=mark_collisions, show_grayscale=show_grayscale)
+
+    normalize_image(image, input_f, output_f, padding, tolerance, image_size, mark_collisions,
+                    show_grayscale, show_color, write_log, bounds, output_archive, name)
+
+
+# Bounds index of a worker process, opened by init_worker.
+_worker_bounds_index = None
+
+
+def init_worker(bounds_index_f):
+    global _worker_bounds_index
+    if bounds_index_f is not None:
+        # Every worker writes through its own connection and commits each row,
+        # so none of them holds the write lock for long.
+        _worker_bounds_index = BoundsIndex(bounds_index_f, commit_every=1)
+
+
+def process_job(input_f, *args):
+    process_image(input_f, *args, bounds_index=_worker_bounds_index)
+
+
+def sync_output(sync_index, input_f, output_f, size, mtime):
+    # size and mtime are the ones seen before processing; a file rewritten
+    # while it was being processed then still counts as changed next time.
+    sync_index.put(os.path.abspath(input_f), size, mtime, output_path(input_f, output_f))
+
+
+def prune_output(sync_index, input_f):
+    output = sync_index.output(input_f)
+    if output is not None and os.path.exists(output):
+        os.remove(output)
+    sync_index.remove(input_f)
+
+
+def process_folder(input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log, force_replace=False, bounds_index=None, output_archive=None, index_only=False, jobs=1, sync_index=None, prune=False, batch_size=1, pipeline=None):
+    pending = []
+    states = {}
+    if sync_index is not None and not index_only:
+        # The index stands in for checking every output: only new or modified
+        # inputs are processed, and outputs of removed inputs can be deleted.
+        changed, removed = sync_index.changes(input_f, force_replace)
+        for f, size, mtime in changed:
+            states[f] = (size, mtime)
+            pending.append((estimate_cost(f), f))
+        if prune:
+            for f in removed:
+                prune_output(sync_index, f)
+    else:
+        for filename in os.listdir(input_f):
+            f = os.path.join(input_f, filename)
+            if os.path.isfile(f) and supported_extension(f):
+                if index_only:
+                    index_image(f, tolerance, bounds_index)
+                    continue
+
+                if output_archive is None and os.path.exists(output_path(f, output_f)) and not force_replace:
+                    continue
+
+                pending.append((estimate_cost(f), f))
+
+    # Largest images first, so a huge file does not stall the tail of a
+    # parallel run.
+    pending.sort(reverse=True)
+    report = ProgressReport(sum(cost for cost, _ in pending), len(pending))
+
+    if pipeline is not None and output_archive is None:
+        costs = {f: cost for cost, f in pending}
+
+        def pipeline_done(f, error):
+            if error is not None:
+                logging.error('%s: %s', f, error)
+            elif sync_index is not None:
+                sync_output(sync_index, f, output_f, *states[f])
+            report.advance(costs[f])
+            print_progress(report)
+
+        decoders, resizers, encoders = pipeline
+        # The costs already hold every pixel count, so the pipeline need not
+        # read the headers again. Animations count all their frames, which
+        # only makes the decoded slots larger than needed.
+        stage_stats = run_pipeline([f for _, f in pending], output_f, padding, tolerance, image_size,
+                                   decoders, resizers, encoders, on_done=pipeline_done, write_log=write_log,
+                                   bounds_index_f=bounds_index.path if bounds_index is not None else None,
+                                   largest=max(costs.values(), default=0))
+        if pending:
+            print()
+            print(utilization_report(stage_stats))
+        return
+    elif jobs > 1 and output_archive is None:
+        with ProcessPoolExecutor(jobs, initializer=init_worker,
+                                 initargs=(bounds_index.path if bounds_index is not None else None,)) as executor:
+            futures = {executor.submit(process_job, f, output_f, padding, tolerance, image_size,
+                                       mark_collisions, show_grayscale, show_color, write_log): (cost, f)
+                       for cost, f in pending}
+            for future in as_completed(futures):
+                cost, f = futures[future]
+                future.result()
+                if sync_index is not None:
+                    sync_output(sync_index, f, output_f, *states[f])
+                report.advance(cost)
+                print_progress(report)
+    elif batch_size > 1 and bounds_index is None and not mark_collisions and not show_grayscale:
+        # Same-size images get their bounds from one stacked reduction; each
+        # image goes on to crop/resize as soon as its batch is done. The bounds
+        # equal image_boundbox's, so crops match a plain or -b run.
+        costs = {f: cost for cost, f in pending}
+        images = (Image.open(f) for _, f in pending)
+        for image, bounds in batch_boundbox(images, tolerance=tolerance, batch_size=batch_size):
+            f = image.filename
+            # Multi-frame images need the union of all frames, not the first.
+            normalize_image(image, f, output_f, padding, tolerance, image_size, mark_collisions,
+                            show_grayscale, show_color, write_log,
+                            None if is_multi_frame(image) else bounds, output_archive)
+            if sync_index is not None:
+                sync_output(sync_index, f, output_f, *states[f])
+            report.advance(costs[f])
+            print_progress(report)
+    else:
+        for cost, f in pending:
+            process_image(f, output_f, padding, tolerance, image_size,
+                          mark_collisions, show_grayscale, show_color, write_log, bounds_index,
+                          output_archive=output_archive)
+            if sync_index is not None:
+                sync_output(sync_index, f, output_f, *states[f])
+            report.advance(cost)
+            print_progress(report)
+    if pending:
+        print()
+
+
+def analyze(input_f, report_f, padding, tolerance, image_size):
+    if os.path.isfile(input_f) and is_archive(input_f):
+        items = archive_members(input_f)
+        report = ProgressReport(total_count=len(archive_names(input_f)) if is_zip(input_f) else 0)
+    elif os.path.isfile(input_f):
+        items = [(input_f, None)]
+        report = ProgressReport(total_count=1)
+    elif os.path.isdir(input_f):
+        items = [(os.path.join(input_f, filename), None) for filename in os.listdir(input_f)
+                 if os.path.isfile(os.path.join(input_f, filename)) and supported_extension(filename)]
+        report = ProgressReport(total_count=len(items))
+    else:
+        quit()
+
+    rows = []
+    for f, data in items:
+        try:
+            row = analyze_image(f, data, padding=padding, tolerance=tolerance, image_size=image_size)
+        except Exception as err:
+            logging.error('%s: %s', f, err)
+            report.skip(0)
+            continue
+        rows.append(row)
+        report.advance(row["cost"])
+        print_progress(report)
+    if rows:
+        print()
+
+    summary = {
+        "images": len(rows),
+        "upscaled": sum(1 for row in rows if row["upscaled"]),
+        "empty": sum(1 for row in rows if row["empty"]),
+        "touches_edge": sum(1 for row in rows if row["touches_edge"]),
+        "megapixels": round(sum(row["cost"] for row in rows) / 1e6, 2),
+        "estimated_detect_seconds": round(sum(row["estimated_detect_seconds"] for row in rows), 2),
+        "estimated_seconds": round(sum(row["estimated_seconds"] for row in rows), 2),
+    }
+
+    with open(report_f, "w", newline="", encoding="utf-8") as f:
+        if report_f.lower().endswith(".json"):
+            json.dump({"summary": summary, "files": rows}, f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ["file"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+def print_progress(report):
+    print(report, end="\r", flush=True)
+
+
 def quit():
     usage()
     sys.exit(2)
@@ -91,8 +329,9 @@ def quit():
 
 if __name__ == "__main__":
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hs:i:o:e:t:p:lgmcrw", [
-            "help", "size=", "if=", "of=", "ext=", "threshold=", "padding=", "watch="])
+        opts, args = getopt.getopt(sys.argv[1:], "hs:i:o:e:t:p:lgmcrwbj:", [
+            "help", "size=", "if=", "of=", "ext=", "threshold=", "padding=", "watch=", "bounds-index", "index-only",
+            "jobs=", "sync", "prune", "batch=", "pipeline=", "analyze="])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -109,6 +348,14 @@ if __name__ == "__main__":
     image_size = (800, 800)
     tolerance = 5
     watch = False
+    use_bounds_index = False
+    index_only = False
+    jobs = 1
+    sync = False
+    prune = False
+    batch_size = 1
+    pipeline = None
+    report_f = None
 
     for o, a in opts:
         if o == "-l":
@@ -138,17 +385,69 @@ if __name__ == "__main__":
             image_size = tuple(int(x) for x in a.split(" "))
         elif o in ("-w", "--watch"):
             watch = True
+        elif o in ("-b", "--bounds-index"):
+            use_bounds_index = True
+        elif o == "--index-only":
+            use_bounds_index = True
+            index_only = True
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o == "--sync":
+            sync = True
+        elif o == "--prune":
+            prune = True
+        elif o == "--batch":
+            batch_size = int(a)
+        elif o == "--pipeline":
+            try:
+                pipeline = tuple(int(x) for x in a.split())
+            except ValueError:
+                quit()
+            if len(pipeline) != 3 or min(pipeline) < 1:
+                quit()
+        elif o == "--analyze":
+            report_f = a
 
     logging.basicConfig(filename='journal.log',
                         encoding='utf-8', level=logging.INFO)
     logging.getLogger().addHandler(logging.StreamHandler())
 
-    if watch == True:
+    # The pipeline stages only do folder to folder runs, without the options
+    # that need the whole image in one process.
+    if pipeline is not None and (jobs > 1 or batch_size > 1 or mark_collisions or show_grayscale or show_color
+                                 or not os.path.isdir(input_f) or is_archive(output_f)):
+        print("--pipeline cannot be combined with -j, --batch, -m, -g, -c, archive output or non-folder input.")
+        quit()
+
+    bounds_index = None
+    if use_bounds_index:
+        bounds_index = BoundsIndex(bounds_index_path(output_f))
+
+    sync_index = None
+    if sync:
+        # Sync tracks outputs as files in the output folder.
+        if not os.path.isdir(input_f) or not os.path.isdir(output_f):
+            quit()
+        sync_index = InputIndex(sync_index_path(output_f))
+
+    if report_f is not None:
+        analyze(input_f, report_f, padding, tolerance, image_size)
+
+    elif watch == True:
         if not os.path.isdir(input_f):
             quit()
 
+        # Catch up on whatever changed while nobody was watching.
+        if sync_index is not None:
+            process_folder(input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale,
+                           show_color, write_log, force_replace, bounds_index, jobs=jobs,
+                           sync_index=sync_index, prune=prune, batch_size=batch_size,
+                           pipeline=pipeline)
+            sync_index.commit()
+
         event_handler = EventHandler(
-            output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log)
+            output_f, padding, tolerance, image_size, mark_collisions, show_grayscale, show_color, write_log,
+            bounds_index, sync_index, prune)
         observer = Observer()
         observer.schedule(event_handler, input_f, recursive=True)
         observer.start()
@@ -161,21 +460,49 @@ if __name__ == "__main__":
             observer.join()
 
     else:
-        # Check to see if we're handling single file or folder
-        if os.path.isfile(input_f):
-            process_image(input_f, output_f, padding, tolerance, image_size,
-                          mark_collisions, show_grayscale, show_color, write_log)
+        # Check to see if we're handling an archive, single file or folder
+        output_archive = None
+        if is_archive(output_f) and not index_only:
+            output_archive = ArchiveWriter(output_f)
+
+        if os.path.isfile(input_f) and is_archive(input_f):
+            # Members are streamed, so costs are only known as they arrive. The
+            # member count is cheap to get from a zip's central directory only.
+            report = ProgressReport(total_count=len(archive_names(input_f)) if is_zip(input_f) else 0)
+            for name, data in archive_members(input_f):
+                if index_only:
+                    index_image(name, tolerance, bounds_index, data)
+                    continue
+
+                if output_archive is None and os.path.exists(os.path.join(output_f, member_output_name(name))) and not force_replace:
+                    report.skip(0)
+                    continue
+
+                cost = estimate_cost(name, data)
+                process_image(name, output_f, padding, tolerance, image_size,
+                              mark_collisions, show_grayscale, show_color, write_log, bounds_index,
+                              data, output_archive, member_output_name(name))
+                report.advance(cost)
+                print_progress(report)
+            print()
+        elif os.path.isfile(input_f):
+            if index_only:
+                index_image(input_f, tolerance, bounds_index)
+            else:
+                process_image(input_f, output_f, padding, tolerance, image_size,
+                              mark_collisions, show_grayscale, show_color, write_log, bounds_index,
+                              output_archive=output_archive)
         elif os.path.isdir(input_f):
-            # if it's not a file, then it has to be a folder so we try to create the output location
-            for index, filename in enumerate(os.listdir(input_f)):
-                f = os.path.join(input_f, filename)
-                if os.path.isfile(f) and supported_extension(f):
-                    if os.path.exists(os.path.join(output_f, filename)) and not force_replace:
-                        continue
-
-                    if write_log:
-                        print(index)
-                    process_image(os.path.join(input_f, filename), output_f, padding, tolerance, image_size,
-                                  mark_collisions, show_grayscale, show_color, write_log)
+            process_folder(input_f, output_f, padding, tolerance, image_size, mark_collisions, show_grayscale,
+                           show_color, write_log, force_replace, bounds_index, output_archive, index_only, jobs,
+                           sync_index, prune, batch_size, pipeline)
         else:
             quit()
+
+        if output_archive is not None:
+            output_archive.close()
+
+    if bounds_index is not None:
+        bounds_index.close()
+    if sync_index is not None:
+        sync_index.close()
@@ -0,0 +1,285 @@
+# pp stands for "process pipeline"
+import multiprocessing
+import os
+import queue
+import time
+from multiprocessing import shared_memory
+from PIL import Image
+from iu import scale_to_fit, is_multi_frame, estimate_cost
+from idx import BoundsIndex, digest, indexed_bounds
+from nf import open_image, output_file, normalize_image
+
+
+class SlotRing:
+    # Fixed-size slots in one shared memory block. Only slot numbers and a few
+    # bytes of metadata travel through the queues; pixels never get pickled.
+    def __init__(self, ctx, slots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, slots * slot_bytes))
+        self.free = ctx.Queue()
+        self.ready = ctx.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def view(self, slot, nbytes):
+        start = slot * self.slot_bytes
+        return self.shm.buf[start:start + nbytes]
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class StageClock:
+    # Splits a worker's wall time into busy time and time spent waiting for
+    # input or for a free slot downstream.
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = time.monotonic()
+        self.busy = 0
+        self.waiting_input = 0
+        self.waiting_output = 0
+        self.count = 0
+
+    def wait(self, source, kind):
+        started = time.monotonic()
+        item = source.get()
+        if kind == "input":
+            self.waiting_input += time.monotonic() - started
+        else:
+            self.waiting_output += time.monotonic() - started
+        return item
+
+    def report(self, stats):
+        stats.put((self.stage, time.monotonic() - self.started, self.busy,
+                   self.waiting_input, self.waiting_output, self.count))
+
+
+# Upper bound on the shared memory of both rings together; never more than
+# half of what is free in /dev/shm, which is often small in containers.
+RING_BUDGET = 256 * 1024 * 1024
+
+
+def ring_budget():
+    try:
+        stat = os.statvfs("/dev/shm")
+    except (OSError, AttributeError):
+        return RING_BUDGET
+    return min(RING_BUDGET, stat.f_bavail * stat.f_frsize // 2)
+
+
+def decode_worker(tasks, ring, done, stats, output_f, padding, tolerance, image_size, write_log, bounds_index_f):
+    clock = StageClock("decode")
+    bounds_index = BoundsIndex(bounds_index_f, commit_every=1) if bounds_index_f is not None else None
+    while True:
+        input_f = clock.wait(tasks, "input")
+        if input_f is None:
+            break
+
+        started = time.monotonic()
+        try:
+            key = None
+            if bounds_index is None:
+                image = Image.open(input_f)
+            else:
+                image, data = open_image(input_f)
+                key = digest(data)
+            # Frames share one union bounding box and are streamed to the
+            # encoder; inputs larger than a slot would not fit the ring. Both
+            # are processed whole, here.
+            if is_multi_frame(image) or image.width * image.height * 3 > ring.slot_bytes:
+                bounds = None
+                if bounds_index is not None:
+                    bounds = indexed_bounds(image, key, tolerance, bounds_index)
+                normalize_image(image, input_f, output_f, padding, tolerance, image_size,
+                                False, False, False, write_log, bounds)
+                done.put((input_f, None))
+                clock.busy += time.monotonic() - started
+                clock.count += 1
+                continue
+
+            image = image.convert("RGB")
+            data = image.tobytes()
+        except Exception as err:
+            done.put((input_f, str(err)))
+            clock.busy += time.monotonic() - started
+            continue
+        clock.busy += time.monotonic() - started
+
+        slot = clock.wait(ring.free, "output")
+        started = time.monotonic()
+        ring.view(slot, len(data))[:] = data
+        ring.ready.put((slot, input_f, image.size, key))
+        clock.busy += time.monotonic() - started
+        clock.count += 1
+
+    clock.report(stats)
+    ring.close()
+    if bounds_index is not None:
+        bounds_index.close()
+
+
+def resize_worker(ring_in, ring_out, done, stats, padding, tolerance, image_size, write_log, bounds_index_f):
+    clock = StageClock("resize")
+    bounds_index = BoundsIndex(bounds_index_f, commit_every=1) if bounds_index_f is not None else None
+    while True:
+        item = clock.wait(ring_in.ready, "input")
+        if item is None:
+            break
+
+        slot, input_f, size, key = item
+        started = time.monotonic()
+        # Copy out of the slot and hand it back before the slow part.
+        image = Image.frombytes("RGB", size, ring_in.view(slot, size[0] * size[1] * 3))
+        ring_in.free.put(slot)
+        image.filename = input_f
+        try:
+            bounds = None
+            if bounds_index is not None:
+                bounds = indexed_bounds(image, key, tolerance, bounds_index)
+            image = scale_to_fit(image, padding=padding, tolerance=tolerance, image_size=image_size,
+                                 write_log=write_log, bounds=bounds)
+            data = image.tobytes()
+        except Exception as err:
+            done.put((input_f, str(err)))
+            clock.busy += time.monotonic() - started
+            continue
+        clock.busy += time.monotonic() - started
+
+        slot = clock.wait(ring_out.free, "output")
+        started = time.monotonic()
+        ring_out.view(slot, len(data))[:] = data
+        ring_out.ready.put((slot, input_f))
+        clock.busy += time.monotonic() - started
+        clock.count += 1
+
+    clock.report(stats)
+    ring_in.close()
+    ring_out.close()
+    if bounds_index is not None:
+        bounds_index.close()
+
+
+def encode_worker(ring, done, stats, output_f, image_size):
+    clock = StageClock("encode")
+    while True:
+        item = clock.wait(ring.ready, "input")
+        if item is None:
+            break
+
+        slot, input_f = item
+        started = time.monotonic()
+        image = Image.frombytes("RGB", image_size, ring.view(slot, image_size[0] * image_size[1] * 3))
+        ring.free.put(slot)
+        try:
+            image.save(output_file(output_f, os.path.basename(input_f)))
+            done.put((input_f, None))
+            clock.count += 1
+        except Exception as err:
+            done.put((input_f, str(err)))
+        clock.busy += time.monotonic() - started
+
+    clock.report(stats)
+    ring.close()
+
+
+def run_pipeline(input_files, output_f, padding=50, tolerance=5, image_size=(800, 800), decoders=1, resizers=1, encoders=1, slots=None, on_done=None, write_log=False, bounds_index_f=None, largest=None):
+    # Calls on_done(input_f, error) as images leave the pipeline and returns the
+    # per-stage stats once every worker has stopped. largest is the pixel count
+    # of the biggest input, if the caller already knows it.
+    if min(decoders, resizers, encoders) < 1:
+        raise ValueError("Every pipeline stage needs at least one worker.")
+    ctx = multiprocessing.get_context()
+    if slots is None:
+        slots = 2 * max(decoders, resizers, encoders)
+
+    # Resized slots have a known size and get up to half the budget, at least
+    # one slot. Decoded slots share the rest: fewer of them for large inputs,
+    # and inputs larger than the whole remainder are handled in the decoder.
+    budget = ring_budget()
+    resized_bytes = image_size[0] * image_size[1] * 3
+    resized_slots = min(slots, max(1, budget // 2 // resized_bytes))
+    if resized_slots * resized_bytes > budget:
+        raise ValueError(f"A {image_size[0]}x{image_size[1]} output does not fit the "
+                         f"{budget // (1024 * 1024)} MB of shared memory available to the pipeline.")
+    budget -= resized_slots * resized_bytes
+
+    if largest is None:
+        largest = max((estimate_cost(input_f) for input_f in input_files), default=0)
+    largest *= 3
+    decoded_slots = min(slots, max(1, budget // max(1, largest)))
+    decoded_bytes = min(largest, budget // decoded_slots)
+
+    decoded = SlotRing(ctx, decoded_slots, decoded_bytes)
+    resized = SlotRing(ctx, resized_slots, resized_bytes)
+    tasks = ctx.Queue()
+    done = ctx.Queue()
+    stats = ctx.Queue()
+
+    workers = []
+    for _ in range(decoders):
+        workers.append(ctx.Process(target=decode_worker,
+                                   args=(tasks, decoded, done, stats, output_f, padding, tolerance, image_size,
+                                         write_log, bounds_index_f)))
+    for _ in range(resizers):
+        workers.append(ctx.Process(target=resize_worker,
+                                   args=(decoded, resized, done, stats, padding, tolerance, image_size,
+                                         write_log, bounds_index_f)))
+    for _ in range(encoders):
+        workers.append(ctx.Process(target=encode_worker,
+                                   args=(resized, done, stats, output_f, image_size)))
+
+    try:
+        for worker in workers:
+            worker.start()
+
+        for input_f in input_files:
+            tasks.put(input_f)
+
+        remaining = len(input_files)
+        while remaining > 0:
+            try:
+                input_f, error = done.get(timeout=1)
+            except queue.Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise RuntimeError("A pipeline worker exited unexpectedly.")
+                continue
+            remaining -= 1
+            if on_done is not None:
+                on_done(input_f, error)
+
+        for _ in range(decoders):
+            tasks.put(None)
+        for _ in range(resizers):
+            decoded.ready.put(None)
+        for _ in range(encoders):
+            resized.ready.put(None)
+
+        stage_stats = [stats.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        decoded.unlink()
+        resized.unlink()
+
+    return stage_stats
+
+
+def utilization_report(stage_stats):
+    lines = []
+    for stage in ("decode", "resize", "encode"):
+        rows = [row for row in stage_stats if row[0] == stage]
+        wall = sum(row[1] for row in rows)
+        if not rows or wall <= 0:
+            continue
+        busy, waiting_input, waiting_output = (sum(row[i] for row in rows) for i in (2, 3, 4))
+        lines.append(f"{stage}: {len(rows)} workers | {sum(row[5] for row in rows)} images | "
+                     f"busy {busy / wall * 100:.0f}% | waiting for input {waiting_input / wall * 100:.0f}% | "
+                     f"waiting for slots {waiting_output / wall * 100:.0f}%")
+    return "\n".join(lines)
@@ -0,0 +1,58 @@
+# pr stands for "progress report"
+import datetime
+import time
+
+
+class ProgressReport:
+    # Progress is weighted by cost (pixel count) rather than file count, so a
+    # batch mixing thumbnails and 80 MB scans still gives a usable ETA. When
+    # the total cost is unknown (streamed archives) it falls back to counts.
+    def __init__(self, total_cost=0, total_count=0):
+        self.total_cost = total_cost
+        self.total_count = total_count
+        self.done_cost = 0
+        self.done_count = 0
+        self.started = time.monotonic()
+
+    def advance(self, cost):
+        self.done_cost += cost
+        self.done_count += 1
+
+    def skip(self, cost):
+        # Work that turned out not to be needed leaves the totals, so it does
+        # not inflate the rates.
+        self.total_cost = max(0, self.total_cost - cost)
+        self.total_count = max(0, self.total_count - 1)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def completion(self):
+        if self.total_cost > 0:
+            return min(100, self.done_cost / self.total_cost * 100)
+        if self.total_count > 0:
+            return min(100, self.done_count / self.total_count * 100)
+        return 0
+
+    def images_per_second(self):
+        elapsed = self.elapsed()
+        return self.done_count / elapsed if elapsed > 0 else 0
+
+    def megapixels_per_second(self):
+        elapsed = self.elapsed()
+        return self.done_cost / 1e6 / elapsed if elapsed > 0 else 0
+
+    def eta(self):
+        elapsed = self.elapsed()
+        if self.total_cost > 0 and self.done_cost > 0:
+            return (self.total_cost - self.done_cost) / (self.done_cost / elapsed)
+        if self.total_count > 0 and self.done_count > 0:
+            return (self.total_count - self.done_count) / (self.done_count / elapsed)
+        return None
+
+    def __str__(self):
+        eta = self.eta()
+        eta = str(datetime.timedelta(seconds=int(eta))) if eta is not None else "--"
+        total = f"/{self.total_count} images ({self.completion():.1f}%)" if self.total_count > 0 else " images"
+        return (f"{self.done_count}{total} | "
+                f"{self.images_per_second():.2f} img/s | {self.megapixels_per_second():.1f} MP/s | ETA {eta}")
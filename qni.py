@@ -4,8 +4,9 @@ from PyQt6.QtGui import QFocusEvent, QIntValidator, QValidator, QPixmap, QIcon
 from PyQt6.QtWidgets import (QWidget,
                              QApplication, QMainWindow, QFileDialog, QListWidgetItem)
 from QNI_UI import Ui_MainWindowQNI
-from PyQt6.QtCore import QThreadPool, QThread, QSize
-from iu import _SUPPORTED_FORMATS
+from PyQt6.QtCore import QThreadPool, QThread, QSize, QTimer
+from iu import _SUPPORTED_FORMATS, supported_extension
+from ia import is_archive
 from ipw import *
 import sys
 import os
@@ -14,6 +15,7 @@ import logging
 
 class Window(QMainWindow):
     stop_thread = pyqtSignal()
+    preview_requested = pyqtSignal(int, str, int, int, object)
 
     def __init__(self):
         QMainWindow.__init__(self)
@@ -37,13 +39,34 @@ class Window(QMainWindow):
         self.write_log = False
         self.output_extension = ".jpg"
         self.running = False
+        self.preview_file = ""
+        self.preview_generation = 0
+        self.ui.spinBoxTolerance.setValue(self.tolerance)
+
+        # Preview renders run on a proxy image in their own thread. Requests are
+        # debounced and numbered so stale renders are dropped by the worker.
+        self.preview_thread = QThread()
+        self.preview_worker = PreviewWorker()
+        self.preview_worker.moveToThread(self.preview_thread)
+        self.preview_requested.connect(self.preview_worker.render)
+        self.preview_worker.result_image.connect(self.preview_result)
+        self.preview_worker.error.connect(self.preview_error)
+        self.preview_thread.start()
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(30)
+        self.preview_timer.timeout.connect(self.request_preview)
 
         # Connect signals and slots for GUI
         self.ui.pushButtonSelectInput.clicked.connect(self.select_input_file)
         self.ui.pushButtonSelectOutput.clicked.connect(self.select_output_file)
+        self.ui.lineEditInputPath.editingFinished.connect(self.change_input_path)
         self.ui.radioButtonModeFile.clicked.connect(self.select_mode)
         self.ui.radioButtonModeFolder.clicked.connect(self.select_mode)
         self.ui.spinBoxPadding.valueChanged.connect(self.change_padding)
+        self.ui.spinBoxTolerance.valueChanged.connect(self.change_tolerance)
+        self.ui.listWidgetThumbnails.currentItemChanged.connect(
+            self.select_preview_item)
         self.ui.pushButtonStart.clicked.connect(self.start)
         self.ui.pushButtonStop.clicked.connect(self.stop)
         self.ui.lineEditWidth.editingFinished.connect(self.change_output_size)
@@ -72,6 +95,15 @@ class Window(QMainWindow):
                 self, "Select input directory.", os.getcwd())
 
         self.ui.lineEditInputPath.setText(self.input)
+        self.select_preview_file()
+
+    def change_input_path(self):
+        # Lets folder mode take a zip/tar archive, which the directory dialog
+        # cannot select.
+        path = self.ui.lineEditInputPath.text()
+        if path != self.input and (os.path.isdir(path) or is_archive(path)):
+            self.input = path
+            self.select_preview_file()
 
     def select_output_file(self):
         dlg = QFileDialog()
@@ -83,6 +115,11 @@ class Window(QMainWindow):
 
     def change_padding(self):
         self.padding = self.ui.spinBoxPadding.value()
+        self.schedule_preview()
+
+    def change_tolerance(self):
+        self.tolerance = self.ui.spinBoxTolerance.value()
+        self.schedule_preview()
 
     def change_output_extension(self):
         self.extension = self.ui.comboBoxExtension.currentText()
@@ -130,6 +167,50 @@ class Window(QMainWindow):
         self.ui.lineEditWidth.setText(str(self.image_size[0]))
         self.ui.lineEditHeight.setText(str(self.image_size[1]))
         print(self.image_size)
+        self.schedule_preview()
+
+    def select_preview_file(self):
+        self.preview_file = ""
+        if self.mode == Mode.FILE:
+            if supported_extension(self.input):
+                self.preview_file = self.input
+        elif os.path.isdir(self.input):
+            for filename in sorted(os.listdir(self.input)):
+                if supported_extension(filename):
+                    self.preview_file = os.path.join(self.input, filename)
+                    break
+        self.schedule_preview()
+
+    def select_preview_item(self, item):
+        if item is None or self.mode != Mode.FOLDER:
+            return
+        f = os.path.join(self.input, item.text())
+        if os.path.isfile(f):
+            self.preview_file = f
+            self.schedule_preview()
+
+    def schedule_preview(self):
+        # Restarting the timer collapses a burst of changes into one render.
+        self.preview_timer.start()
+
+    def request_preview(self):
+        if self.preview_file == "":
+            return
+        self.preview_generation += 1
+        self.preview_worker.latest = self.preview_generation
+        self.preview_requested.emit(self.preview_generation, self.preview_file,
+                                    self.padding, self.tolerance, self.image_size)
+
+    def preview_result(self, generation, image):
+        if generation != self.preview_generation:
+            return
+        from PIL.ImageQt import ImageQt
+        self.ui.labelPreview.setPixmap(QPixmap.fromImage(ImageQt(image)))
+
+    def preview_error(self, generation, message):
+        if generation != self.preview_generation:
+            return
+        self.ui.labelPreview.setText(message)
 
     def image_result(self, filename, image, completion):
         from PIL.ImageQt import ImageQt
@@ -141,7 +222,6 @@ class Window(QMainWindow):
         self.ui.listWidgetThumbnails.setGridSize(QSize(4, 4))
 
         self.ui.listWidgetThumbnails.addItem(item)
-        self.ui.statusbar.showMessage(f'Processing {filename}', 0)
         self.ui.progressBar.setValue(int(completion))
 
     def disable_interface(self):
@@ -193,6 +273,7 @@ class Window(QMainWindow):
 
         self.worker_thread.started.connect(self.worker.start)
         self.worker.result_image.connect(self.image_result)
+        self.worker.status.connect(self.ui.statusbar.showMessage)
         self.worker.finished.connect(self.worker_thread.quit)
         self.worker.finished.connect(self.worker.deleteLater)
         self.worker_thread.finished.connect(self.worker_thread.deleteLater)
@@ -207,6 +288,11 @@ class Window(QMainWindow):
         self.enable_interface()
         self.stop_thread.emit()
 
+    def closeEvent(self, event):
+        self.preview_thread.quit()
+        self.preview_thread.wait()
+        QMainWindow.closeEvent(self, event)
+
 
 logging.basicConfig(filename='journal.log',
                     encoding='utf-8', level=logging.INFO)